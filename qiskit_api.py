@@ -1,11 +1,17 @@
-from fastapi import FastAPI
+import base64
+import glob
+import hashlib
+import os
+
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import numpy as np
 
 # Qiskit 라이브러리 임포트
 from qiskit import QuantumCircuit, transpile
+from qiskit.circuit import Parameter
 from qiskit_aer import AerSimulator
 
 app = FastAPI(title="E91 QKD Simulator API")
@@ -20,226 +26,356 @@ app.add_middleware(
 )
 
 # 시뮬레이터 초기화
-simulator = AerSimulator()
+# - 2큐비트 회로이므로 single precision statevector로 충분 (backend 자동 탐색 생략)
+# - 여러 회로를 한 번에 제출하면 Aer가 CPU 코어에 나눠 병렬 실행
+# - 게이트 fusion은 2큐비트 회로에서 이득이 없으므로 비활성화
+simulator = AerSimulator(
+    method="statevector",
+    precision="single",
+    max_parallel_experiments=os.cpu_count(),
+    max_parallel_threads=os.cpu_count(),
+    fusion_enable=False,
+)
+
+# 프로세스 전역 난수 생성기 (PCG64, legacy np.random.* 전역 상태 대신 사용)
+rng = np.random.default_rng()
 
 # --- 데이터 모델 정의 ---
 class CHSHRequest(BaseModel):
     shots: int = 1024
+    monte_carlo: bool = False  # True면 AerSimulator로 샷 기반 추정 (교육용 데모)
 
 class KeyGenRequest(BaseModel):
-    count: int = 50
+    count: int = Field(50, ge=0)
+    packed: bool = False  # True면 비트/기저를 base64 바이트열로 압축해서 반환
+
+class KeyGenResponse(BaseModel):
+    # packed=False: 정수 리스트, packed=True: base64 문자열
+    # (기저는 각도별 uint8 1바이트, 비트는 np.packbits로 8개씩 1바이트)
+    alice_bases: list[int] | str
+    bob_bases: list[int] | str
+    raw_bits_a: list[int] | str
+    raw_bits_b: list[int] | str
+    packed: bool = False
+    count: int
 
 class EveRequest(BaseModel):
     shots: int = 1000
     intercept_prob: float = 0.5
 
+# --- Bell 상태 측정 회로 ---
+# 사용되는 모든 측정 각도의 라디안 값 (요청마다 np.radians 호출을 피함)
+_RAD = {a: float(np.radians(a)) for a in (0, 22.5, 45, 67.5, 90, 135)}
+
+# CHSH 각도 설정
+CHSH_PAIRS = [
+    (0, 22.5),   # E1
+    (0, 67.5),   # E2
+    (45, 22.5),  # E3
+    (45, 67.5)   # E4
+]
+
+# 측정 기저 회전각 파라미터 (RY 회전각 = -2 * theta)
+ROT_A = Parameter("rot_a")
+ROT_B = Parameter("rot_b")
+ROT_E = Parameter("rot_e")
+
+def build_bell_circuit():
+    """
+    |Phi+> 상태를 만들고 Alice/Bob 기저 각도로 측정하는 파라미터 회로를 생성합니다.
+    """
+    # FIX: QuantumCircuit에 classical registers 명시
+    qc = QuantumCircuit(2, 2)  # 2 qubits, 2 classical bits
+    
+    # 1. 벨 상태 생성 |Phi+> = (|00> + |11>)/√2
+    qc.h(0)
+    qc.cx(0, 1)
+    
+    # 2. 측정 기저 회전 (각도는 실행 전에 바인딩)
+    qc.ry(ROT_A, 0)
+    qc.ry(ROT_B, 1)
+    
+    # 3. 측정 (FIX: measure_all() 대신 명시적 측정)
+    qc.measure(0, 0)  # Alice
+    qc.measure(1, 1)  # Bob
+    return qc
+
+# 회로 골격은 모든 각도 쌍에서 같으므로 import 시점에 한 번만 transpile
+_BELL_TEMPLATE = transpile(build_bell_circuit(), simulator)
+
+def get_bell_circuit(theta_a, theta_b):
+    """
+    transpile된 Bell 템플릿에 각도 쌍을 바인딩해 반환합니다.
+    """
+    # FIX: 각도를 라디안으로 변환하고 올바른 방향으로 회전
+    return _BELL_TEMPLATE.assign_parameters({ROT_A: -2 * _RAD[theta_a], ROT_B: -2 * _RAD[theta_b]})
+
+def correlation_from_counts(counts, shots):
+    """
+    측정 결과 counts로부터 상관계수 E = (N_same - N_diff) / Total을 계산합니다.
+    
+    Alice/Bob 결과는 cbit 0, 1에 있으므로 정수 키의 하위 2비트만 봅니다 (Eve의 cbit 2, 3 무시).
+    """
+    # Qiskit bit order: rightmost is cbit 0
+    # 0 (00) / 3 (11) means same, 1 (01) / 2 (10) means different
+    n_same_minus_diff = 0
+    for key, v in counts.items():
+        k = int(key.replace(' ', ''), 2) & 0b11
+        n_same_minus_diff += v if k in (0, 3) else -v
+    return n_same_minus_diff / shots
+
+def correlations_for(angles, shots, eve_angles=None):
+    """
+    (N, 2) 각도 배열의 행마다 회로를 바인딩해 한 번의 run 호출로 실행하고 (N,) 상관계수 배열을 반환합니다.
+    
+    eve_angles (길이 N)가 주어지면 Bell 회로 대신 해당 기저의 Eve 회로를 사용합니다.
+    """
+    angles = np.asarray(angles)
+    if eve_angles is None:
+        circuits = [get_bell_circuit(theta_a, theta_b) for theta_a, theta_b in angles]
+    else:
+        circuits = [
+            get_eve_circuit(eve_angle, theta_a, theta_b)
+            for (theta_a, theta_b), eve_angle in zip(angles, eve_angles)
+        ]
+    result = simulator.run(circuits, shots=shots).result()
+    return np.fromiter(
+        (correlation_from_counts(result.get_counts(i), shots) for i in range(len(circuits))),
+        dtype=float,
+        count=len(circuits)
+    )
+
+def s_value_of(correlations):
+    """S = |E1 - E2 + E3 + E4|"""
+    return float(abs(correlations[0] - correlations[1] + correlations[2] + correlations[3]))
+
 # --- Phase 1: CHSH 부등식 검증 (FIXED) ---
 @app.post("/api/phase1/chsh")
-async def run_chsh(req: CHSHRequest):
+def run_chsh(req: CHSHRequest):
     """
-    Qiskit을 사용하여 CHSH 부등식 위반(S-value)을 계산합니다.
+    CHSH 부등식 위반(S-value)을 계산합니다.
+    
+    기본값은 해석적 기댓값 E(theta_a, theta_b) = cos(2(theta_a - theta_b))를 바로 반환하며,
+    monte_carlo=True일 때만 Qiskit AerSimulator로 샷 기반 추정을 수행합니다.
     
     FIX: 측정 전에 classical registers를 제대로 추가
     """
-    # CHSH 각도 설정
-    pairs = [
-        (0, 22.5),   # E1
-        (0, 67.5),   # E2
-        (45, 22.5),  # E3
-        (45, 67.5)   # E4
-    ]
-    
-    correlations = []
-    
-    for theta_a, theta_b in pairs:
-        # FIX: QuantumCircuit에 classical registers 명시
-        qc = QuantumCircuit(2, 2)  # 2 qubits, 2 classical bits
-        
-        # 1. 벨 상태 생성 |Phi+> = (|00> + |11>)/√2
-        qc.h(0)
-        qc.cx(0, 1)
+    if not req.monte_carlo:
+        correlations = [float(np.cos(2 * (_RAD[theta_a] - _RAD[theta_b]))) for theta_a, theta_b in CHSH_PAIRS]
+        s_value = s_value_of(correlations)
         
-        # 2. 측정 기저 회전
-        # FIX: 각도를 라디안으로 변환하고 올바른 방향으로 회전
-        qc.ry(-2 * np.radians(theta_a), 0)
-        qc.ry(-2 * np.radians(theta_b), 1)
-        
-        # 3. 측정 (FIX: measure_all() 대신 명시적 측정)
-        qc.measure(0, 0)
-        qc.measure(1, 1)
-        
-        # 4. 시뮬레이션 실행
-        transpiled_qc = transpile(qc, simulator)
-        job = simulator.run(transpiled_qc, shots=req.shots)
-        counts = job.result().get_counts()
-        
-        # 5. 상관계수 계산
-        # Qiskit bit order: rightmost is qubit 0
-        # '00' means both measured 0, '11' means both measured 1
-        n_same = counts.get('00', 0) + counts.get('11', 0)
-        n_diff = counts.get('01', 0) + counts.get('10', 0)
-        
-        # E = (N_same - N_diff) / Total
-        corr = (n_same - n_diff) / req.shots
-        correlations.append(round(corr, 4))
+        return {
+            "s_value": round(s_value, 4),
+            "correlations": [round(c, 4) for c in correlations],
+            "violation": s_value > 2.0,
+            "source": "Analytic (closed-form)"
+        }
     
-    # S = E1 - E2 + E3 + E4 (no absolute value first)
-    s_raw = correlations[0] - correlations[1] + correlations[2] + correlations[3]
-    s_value = abs(s_raw)
+    # 4개 회로를 한 번의 run 호출로 제출 (반올림은 응답 직렬화 시점에만)
+    correlations = correlations_for(CHSH_PAIRS, req.shots)
+    s_value = s_value_of(correlations)
     
-    print(f"DEBUG Phase1: Correlations = {correlations}, S = {s_value}")
+    print(f"DEBUG Phase1: Correlations = {correlations.tolist()}, S = {s_value}")
     
     return {
         "s_value": round(s_value, 4),
-        "correlations": correlations,
+        "correlations": [round(float(c), 4) for c in correlations],
         "violation": s_value > 2.0,
         "source": "Qiskit AerSimulator"
     }
 
 # --- Phase 2: 키 생성 (Raw Key Sifting) ---
-@app.post("/api/phase2/keygen")
-async def run_keygen(req: KeyGenRequest):
+# Alice와 Bob의 기저 각도 후보
+BASIS_OPTS_A = np.array([0, 45, 90])
+BASIS_OPTS_B = np.array([45, 90, 135])
+
+# |Phi+>를 (theta_a, theta_b)로 측정했을 때 두 비트가 같을 확률: cos^2(theta_a - theta_b)
+# P(00) = P(11) = cos^2/2, P(01) = P(10) = sin^2/2
+P_SAME = np.cos(np.radians(BASIS_OPTS_A[:, None] - BASIS_OPTS_B[None, :])) ** 2
+
+def sample_keygen(count, p_same, rng):
     """
-    Alice와 Bob의 무작위 기저 선택 및 측정 결과를 시뮬레이션합니다.
+    기저 인덱스와 원시 비트를 NumPy 배열 연산으로 한 번에 샘플링합니다.
+    
+    네 결과 모두 길이 count의 int8 배열 (SoA 레이아웃)입니다.
     """
-    alice_bases = []
-    bob_bases = []
-    raw_bits_a = []
-    raw_bits_b = []
+    # 무작위 기저 선택 (전체 라운드를 한 번에)
+    ia = rng.integers(0, 3, size=count, dtype=np.int8)
+    jb = rng.integers(0, 3, size=count, dtype=np.int8)
     
-    # Alice와 Bob의 기저 각도 후보
-    basis_opts_a = [0, 45, 90]
-    basis_opts_b = [45, 90, 135]
+    # Alice의 비트는 균등 분포, Bob의 비트는 p_same 확률로 Alice와 일치
+    same = rng.random(count) < p_same[ia, jb]
+    bits_a = rng.integers(0, 2, size=count, dtype=np.int8)
+    bits_b = np.where(same, bits_a, 1 - bits_a).astype(np.int8, copy=False)
+    return ia, jb, bits_a, bits_b
+
+def _b64(arr):
+    """uint8 배열을 base64 문자열로 인코딩합니다."""
+    return base64.b64encode(np.ascontiguousarray(arr, dtype=np.uint8).tobytes()).decode()
+
+@app.post("/api/phase2/keygen", response_model=KeyGenResponse)
+def run_keygen(req: KeyGenRequest):
+    """
+    Alice와 Bob의 무작위 기저 선택 및 측정 결과를 시뮬레이션합니다.
     
-    for _ in range(req.count):
-        # 무작위 기저 선택
-        b_a = int(np.random.choice(basis_opts_a))
-        b_b = int(np.random.choice(basis_opts_b))
-        
-        qc = QuantumCircuit(2, 2)
-        
-        # Bell state
-        qc.h(0)
-        qc.cx(0, 1)
-        
-        # Rotate to measurement bases
-        qc.ry(-2 * np.radians(b_a), 0)
-        qc.ry(-2 * np.radians(b_b), 1)
-        
-        # Measure
-        qc.measure(0, 0)  # Alice
-        qc.measure(1, 1)  # Bob
-        
-        # 1회 샷 실행
-        job = simulator.run(transpile(qc, simulator), shots=1)
-        res = list(job.result().get_counts().keys())[0]
-        
-        # Qiskit order: res[1] = qubit 0 (Alice), res[0] = qubit 1 (Bob)
-        bit_a = int(res[1])
-        bit_b = int(res[0])
-        
-        alice_bases.append(b_a)
-        bob_bases.append(b_b)
-        raw_bits_a.append(bit_a)
-        raw_bits_b.append(bit_b)
+    측정 결과 분포가 해석적으로 알려져 있으므로 시뮬레이터 대신 NumPy로 직접 샘플링합니다.
+    """
+    ia, jb, raw_bits_a, raw_bits_b = sample_keygen(req.count, P_SAME, rng)
     
-    return {
-        "alice_bases": alice_bases,
-        "bob_bases": bob_bases,
-        "raw_bits_a": raw_bits_a,
-        "raw_bits_b": raw_bits_b
-    }
+    if req.packed:
+        # 큰 count에서 JSON 정수 리스트 대신 압축된 바이트열 반환 (np.unpackbits로 복원)
+        return KeyGenResponse(
+            alice_bases=_b64(BASIS_OPTS_A[ia]),
+            bob_bases=_b64(BASIS_OPTS_B[jb]),
+            raw_bits_a=_b64(np.packbits(raw_bits_a.astype(np.uint8))),
+            raw_bits_b=_b64(np.packbits(raw_bits_b.astype(np.uint8))),
+            packed=True,
+            count=req.count
+        )
+    
+    return KeyGenResponse(
+        alice_bases=BASIS_OPTS_A[ia].tolist(),
+        bob_bases=BASIS_OPTS_B[jb].tolist(),
+        raw_bits_a=raw_bits_a.tolist(),
+        raw_bits_b=raw_bits_b.tolist(),
+        count=req.count
+    )
 
 # --- Phase 3: 도청자(Eve) 개입 (FIXED) ---
+def build_eve_circuit():
+    """
+    Eve의 intercept-resend 공격을 mid-circuit measurement로 표현한 파라미터 회로를 생성합니다.
+    
+    cbit 0, 1: Alice/Bob 측정 결과, cbit 2, 3: Eve의 측정 결과
+    """
+    qc = QuantumCircuit(2, 4)
+    
+    # 초기 얽힘 생성
+    qc.h(0)
+    qc.cx(0, 1)
+    
+    # Eve가 같은 기저로 두 큐비트를 측정 (얽힘 붕괴!)
+    qc.ry(ROT_E, 0)
+    qc.ry(ROT_E, 1)
+    qc.measure(0, 2)
+    qc.measure(1, 3)
+    
+    # Eve가 재전송: 측정 결과를 |0>에서 다시 준비
+    qc.reset([0, 1])
+    with qc.if_test((qc.clbits[2], 1)):  # Alice's qubit
+        qc.x(0)
+    with qc.if_test((qc.clbits[3], 1)):  # Bob's qubit
+        qc.x(1)
+    
+    # 이제 Alice와 Bob이 측정
+    qc.ry(ROT_A, 0)
+    qc.ry(ROT_B, 1)
+    qc.measure(0, 0)
+    qc.measure(1, 1)
+    return qc
+
+_EVE_TEMPLATE = transpile(build_eve_circuit(), simulator)
+
+def get_eve_circuit(eve_angle, theta_a, theta_b):
+    """
+    transpile된 Eve 템플릿에 Eve/Alice/Bob 각도를 바인딩해 반환합니다.
+    """
+    return _EVE_TEMPLATE.assign_parameters({
+        ROT_E: -2 * _RAD[eve_angle],
+        ROT_A: -2 * _RAD[theta_a],
+        ROT_B: -2 * _RAD[theta_b]
+    })
+
 @app.post("/api/phase3/attack")
-async def run_eve_attack(req: EveRequest):
+def run_eve_attack(req: EveRequest):
     """
     도청자 Eve가 중간에 개입할 때 S-value 붕괴 시뮬레이션
     
     FIX: Eve가 없을 때도 정상 작동하도록 수정
     """
-    pairs = [(0, 22.5), (0, 67.5), (45, 22.5), (45, 67.5)]
-    correlations = []
-    
-    for theta_a, theta_b in pairs:
-        # FIX: 조건부로 회로 생성
-        if np.random.random() < req.intercept_prob:
-            # ===== EVE INTERCEPTS =====
-            # Eve가 측정하면 얽힘이 붕괴됨
-            # 간단한 모델: Eve 측정 후 고전 상태로 전환
-            
-            qc = QuantumCircuit(2, 2)
-            
-            # 초기 얽힘 생성
-            qc.h(0)
-            qc.cx(0, 1)
-            
-            # Eve의 측정 (무작위 기저)
-            eve_angle = np.random.choice([0, 45, 90])
-            qc.ry(-2 * np.radians(eve_angle), 0)
-            qc.ry(-2 * np.radians(eve_angle), 1)
-            
-            # Eve가 측정 (얽힘 붕괴!)
-            qc.measure(0, 0)
-            qc.measure(1, 1)
-            
-            # 중간 측정 결과 확인
-            temp_job = simulator.run(transpile(qc, simulator), shots=1)
-            eve_result = list(temp_job.result().get_counts().keys())[0]
-            
-            # 붕괴된 상태로 새 회로 생성
-            qc = QuantumCircuit(2, 2)
-            
-            # Eve가 재전송: 측정 결과를 다시 준비
-            if eve_result[1] == '1':  # Alice's qubit
-                qc.x(0)
-            if eve_result[0] == '1':  # Bob's qubit
-                qc.x(1)
-            
-            # 이제 Alice와 Bob이 측정
-            qc.ry(-2 * np.radians(theta_a), 0)
-            qc.ry(-2 * np.radians(theta_b), 1)
-            qc.measure(0, 0)
-            qc.measure(1, 1)
-            
-        else:
-            # ===== NO EVE (NORMAL OPERATION) =====
-            # FIX: Eve가 없을 때는 정상 Bell state 사용
-            qc = QuantumCircuit(2, 2)
-            
-            # 얽힘 생성 (붕괴 없음)
-            qc.h(0)
-            qc.cx(0, 1)
-            
-            # Alice와 Bob 측정
-            qc.ry(-2 * np.radians(theta_a), 0)
-            qc.ry(-2 * np.radians(theta_b), 1)
-            qc.measure(0, 0)
-            qc.measure(1, 1)
-        
-        # 시뮬레이션 실행
-        job = simulator.run(transpile(qc, simulator), shots=req.shots)
-        counts = job.result().get_counts()
-        
-        # 상관계수 계산
-        n_same = counts.get('00', 0) + counts.get('11', 0)
-        n_diff = counts.get('01', 0) + counts.get('10', 0)
-        corr = (n_same - n_diff) / req.shots
-        correlations.append(corr)
+    # 쌍별로 Eve가 가로챈 샷 수와 Eve의 기저를 루프 전에 한 번에 추첨
+    # (샷마다 intercept_prob 확률로 개입 -> 개입 샷 수는 이항분포)
+    n_eve = rng.binomial(req.shots, min(max(req.intercept_prob, 0.0), 1.0), size=len(CHSH_PAIRS))
+    eve_angles = rng.choice([0, 45, 90], size=len(CHSH_PAIRS))
+    
+    # 가중치가 0인 회로는 실행하지 않음: 필요한 쌍만 Bell/Eve 회로별로 한 번씩 일괄 실행
+    # (Eve 회로는 mid-circuit measurement 때문에 샷 단위로 시뮬레이션되므로 샷 수도 필요한 만큼만)
+    pairs = np.asarray(CHSH_PAIRS)
+    bell_corrs = np.zeros(len(pairs))
+    eve_corrs = np.zeros(len(pairs))
+    
+    bell_mask = n_eve < req.shots
+    if bell_mask.any():
+        bell_shots = int((req.shots - n_eve[bell_mask]).max())
+        bell_corrs[bell_mask] = correlations_for(pairs[bell_mask], bell_shots)
+    
+    eve_mask = n_eve > 0
+    if eve_mask.any():
+        eve_shots = int(n_eve[eve_mask].max())
+        eve_corrs[eve_mask] = correlations_for(pairs[eve_mask], eve_shots, eve_angles=eve_angles[eve_mask])
     
-    # S-value 계산
-    s_value = abs(correlations[0] - correlations[1] + correlations[2] + correlations[3])
+    # 쌍별 상관계수 = Eve가 가로챈 샷 비율로 두 회로의 상관계수를 가중 평균
+    eve_frac = n_eve / req.shots
+    correlations = eve_frac * eve_corrs + (1 - eve_frac) * bell_corrs
+    s_value = s_value_of(correlations)
     
-    print(f"DEBUG Phase3: Eve_prob={req.intercept_prob}, S={s_value}, Corr={correlations}")
+    print(f"DEBUG Phase3: Eve_prob={req.intercept_prob}, S={s_value}, Corr={correlations.tolist()}")
     
     return {
         "s_value": round(s_value, 4),
-        "correlations": correlations,
+        "correlations": [round(float(c), 4) for c in correlations],
         "is_secure": s_value > 2.0,
         "eve_active": req.intercept_prob > 0
     }
 
+# --- Warm-up ---
+def _warmup():
+    """
+    import 시점에 템플릿 회로를 1샷씩 실행해 Aer의 지연 초기화를 첫 요청 전에 끝냅니다.
+    
+    실행 결과 메타데이터로 Aer가 실제로 statevector 방식, fusion 비활성으로 실행했는지 확인합니다.
+    """
+    theta_a, theta_b = CHSH_PAIRS[0]
+    circuits = [get_bell_circuit(theta_a, theta_b), get_eve_circuit(0, theta_a, theta_b)]
+    result = simulator.run(circuits, shots=1).result()
+    for exp in result.results:
+        method = exp.metadata.get("method")
+        fusion = exp.metadata.get("fusion", {}).get("enabled")
+        if method != "statevector" or fusion:
+            raise RuntimeError(f"AerSimulator ran with method={method!r}, fusion={fusion!r}; expected statevector without fusion")
+
+_warmup()
+
 # Static files
+# 페이지(html/js)는 import 시점에 메모리에 올려 요청마다 stat/open 없이 ETag와 함께 응답
+_STATIC_CACHE = {}
+
+def _etag_matches(if_none_match, etag):
+    """If-None-Match 헤더(쉼표 구분 목록, weak W/ 접두사 허용)가 etag와 일치하는지 확인합니다."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+def _cached_file_response(name, media_type):
+    # 블로킹 작업이 없으므로 threadpool을 거치지 않도록 async로 처리
+    async def serve(request: Request):
+        content, etag = _STATIC_CACHE[name]
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=content, media_type=media_type, headers={"ETag": etag})
+    return serve
+
+for path in glob.glob("*.html") + glob.glob("*.js"):
+    with open(path, "rb") as f:
+        content = f.read()
+    _STATIC_CACHE[path] = (content, f'"{hashlib.sha1(content).hexdigest()}"')
+    media_type = "text/html" if path.endswith(".html") else "text/javascript"
+    app.add_api_route(f"/{path}", _cached_file_response(path, media_type), methods=["GET"], include_in_schema=False)
+    if path == "index.html":
+        app.add_api_route("/", _cached_file_response(path, media_type), methods=["GET"], include_in_schema=False)
+
+# 나머지 정적 파일(assets 등)은 StaticFiles로 제공
 app.mount("/", StaticFiles(directory=".", html=True), name="static")
 
 if __name__ == "__main__":
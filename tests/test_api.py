@@ -1,9 +1,12 @@
+import base64
 import os
 import sys
 # ensure project root is importable when pytest runs from tests/
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import numpy as np
 from fastapi.testclient import TestClient
+import qiskit_api
 from qiskit_api import app
 
 client = TestClient(app)
@@ -15,6 +18,20 @@ def test_index_served():
     assert "E91 QKD SUITE" in res.text
 
 
+def test_index_etag_not_modified():
+    res = client.get("/")
+    assert res.status_code == 200
+    assert "E91 QKD SUITE" in res.text
+    etag = res.headers["etag"]
+    res = client.get("/index.html", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    # weak and comma-separated validators also match
+    res = client.get("/index.html", headers={"If-None-Match": f'"other", W/{etag}'})
+    assert res.status_code == 304
+    res = client.get("/index.html", headers={"If-None-Match": '"other"'})
+    assert res.status_code == 200
+
+
 def test_chsh_endpoint():
     res = client.post("/api/phase1/chsh", json={"shots": 64})
     assert res.status_code == 200
@@ -24,6 +41,23 @@ def test_chsh_endpoint():
     assert isinstance(data.get("violation"), bool)
 
 
+def test_chsh_analytic_reaches_tsirelson_bound():
+    res = client.post("/api/phase1/chsh", json={})
+    assert res.status_code == 200
+    data = res.json()
+    assert abs(data["s_value"] - 2 * 2 ** 0.5) < 1e-3
+    assert data["violation"] is True
+    assert data["source"] == "Analytic (closed-form)"
+
+
+def test_chsh_monte_carlo_endpoint():
+    res = client.post("/api/phase1/chsh", json={"shots": 64, "monte_carlo": True})
+    assert res.status_code == 200
+    data = res.json()
+    assert len(data["correlations"]) == 4
+    assert data["source"] == "Qiskit AerSimulator"
+
+
 def test_keygen_endpoint():
     n = 10
     res = client.post("/api/phase2/keygen", json={"count": n})
@@ -44,3 +78,65 @@ def test_attack_endpoint():
     data = res.json()
     assert "s_value" in data
     assert "is_secure" in data
+
+
+def test_keygen_matching_bases_agree():
+    res = client.post("/api/phase2/keygen", json={"count": 200})
+    assert res.status_code == 200
+    data = res.json()
+    rows = zip(data["alice_bases"], data["bob_bases"], data["raw_bits_a"], data["raw_bits_b"])
+    for b_a, b_b, bit_a, bit_b in rows:
+        # |Phi+> measured in the same basis is perfectly correlated
+        if b_a == b_b:
+            assert bit_a == bit_b
+
+
+def test_keygen_packed_roundtrip():
+    n = 21
+    res = client.post("/api/phase2/keygen", json={"count": n, "packed": True})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["packed"] is True and data["count"] == n
+    bases_a = np.frombuffer(base64.b64decode(data["alice_bases"]), dtype=np.uint8)
+    bases_b = np.frombuffer(base64.b64decode(data["bob_bases"]), dtype=np.uint8)
+    bits_a = np.unpackbits(np.frombuffer(base64.b64decode(data["raw_bits_a"]), dtype=np.uint8))[:n]
+    bits_b = np.unpackbits(np.frombuffer(base64.b64decode(data["raw_bits_b"]), dtype=np.uint8))[:n]
+    assert len(bases_a) == len(bases_b) == n
+    assert set(bases_a.tolist()) <= {0, 45, 90}
+    assert set(bases_b.tolist()) <= {45, 90, 135}
+    same_basis = bases_a == bases_b
+    assert (bits_a[same_basis] == bits_b[same_basis]).all()
+
+
+def test_keygen_sampler_respects_p_same():
+    ia, jb, bits_a, bits_b = qiskit_api.sample_keygen(500, qiskit_api.P_SAME, np.random.default_rng(0))
+    assert len(ia) == len(jb) == len(bits_a) == len(bits_b) == 500
+    for arr in (ia, jb, bits_a, bits_b):
+        assert arr.dtype == np.int8
+    same_basis = qiskit_api.BASIS_OPTS_A[ia] == qiskit_api.BASIS_OPTS_B[jb]
+    assert (bits_a[same_basis] == bits_b[same_basis]).all()
+    # 0 vs 90 degrees is perfectly anti-correlated
+    orthogonal = (qiskit_api.BASIS_OPTS_A[ia] == 0) & (qiskit_api.BASIS_OPTS_B[jb] == 90)
+    assert (bits_a[orthogonal] != bits_b[orthogonal]).all()
+
+
+def test_keygen_sampler_reproducible_with_seeded_rng():
+    first = qiskit_api.sample_keygen(100, qiskit_api.P_SAME, np.random.default_rng(42))
+    second = qiskit_api.sample_keygen(100, qiskit_api.P_SAME, np.random.default_rng(42))
+    for x, y in zip(first, second):
+        assert (x == y).all()
+
+
+def test_attack_full_intercept_breaks_bell_violation():
+    # Eve's mid-circuit measurement + re-preparation leaves only classical correlations
+    res = client.post("/api/phase3/attack", json={"shots": 4000, "intercept_prob": 1.0})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["s_value"] <= 2.0
+    assert data["is_secure"] is False
+
+
+def test_correlation_ignores_eve_cbits():
+    # cbits 2-3 hold Eve's result; only the low two bits are Alice/Bob
+    counts = {"1100": 3, "0111": 1, "1001": 2}
+    assert qiskit_api.correlation_from_counts(counts, 6) == (3 + 1 - 2) / 6
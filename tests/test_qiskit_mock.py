@@ -2,6 +2,7 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import numpy as np
 from fastapi.testclient import TestClient
 import qiskit_api
 from types import SimpleNamespace
@@ -10,11 +11,11 @@ client = TestClient(qiskit_api.app)
 
 
 class MockJob:
-    def __init__(self, counts):
-        self._counts = counts
+    def __init__(self, counts_list):
+        self._counts_list = counts_list
 
     def result(self):
-        return SimpleNamespace(get_counts=lambda: self._counts)
+        return SimpleNamespace(get_counts=lambda i=0: self._counts_list[i])
 
 
 class MockSim:
@@ -22,14 +23,21 @@ class MockSim:
         self.counts_sequence = counts_sequence or []
         self.calls = 0
         self.num_qubits = 2
-
-    def run(self, *args, **kwargs):
-        if self.calls < len(self.counts_sequence):
-            counts = self.counts_sequence[self.calls]
-        else:
-            counts = {'00': 64, '11': 0, '01': 0, '10': 0}
-        self.calls += 1
-        return MockJob(counts)
+        self.submitted = []
+
+    def run(self, circuits, *args, **kwargs):
+        # A list of circuits consumes one entry of the sequence per circuit
+        n = len(circuits) if isinstance(circuits, list) else 1
+        self.submitted.append(circuits)
+        counts_list = []
+        for _ in range(n):
+            if self.calls < len(self.counts_sequence):
+                counts = self.counts_sequence[self.calls]
+            else:
+                counts = {'00': 64, '11': 0, '01': 0, '10': 0}
+            self.calls += 1
+            counts_list.append(counts)
+        return MockJob(counts_list)
 
 
 def test_chsh_with_mock(monkeypatch):
@@ -42,10 +50,8 @@ def test_chsh_with_mock(monkeypatch):
         {'00': 80},   # E4 -> corr = 1
     ]
     monkeypatch.setattr(qiskit_api, 'simulator', MockSim(counts_sequence=seq))
-    # Avoid qiskit transpiler needing backend target metadata in unit tests
-    monkeypatch.setattr(qiskit_api, 'transpile', lambda qc, backend: qc)
 
-    res = client.post('/api/phase1/chsh', json={'shots': 80})
+    res = client.post('/api/phase1/chsh', json={'shots': 80, 'monte_carlo': True})
     assert res.status_code == 200
     data = res.json()
     assert abs(float(data['s_value']) - 4.0) < 1e-6
@@ -53,27 +59,61 @@ def test_chsh_with_mock(monkeypatch):
 
 
 def test_attack_with_mock(monkeypatch):
-    # Make attack produce a low S-value when intercept_prob=1
+    # Full interception submits only the 4 Eve circuits; anti-correlated counts give a low S-value
     seq = [
-        {'01': 50, '10': 50},
-        {'01': 50, '10': 50},
-        {'01': 50, '10': 50},
-        {'01': 50, '10': 50},
+        {'0001': 50, '0010': 50},   # E1 -> corr = -1
+        {'0001': 50, '0010': 50},   # E2 -> corr = -1
+        {'0100': 75, '0101': 25},   # E3 -> corr = 0.5
+        {'0001': 50, '0010': 50},   # E4 -> corr = -1
     ]
-    monkeypatch.setattr(qiskit_api, 'simulator', MockSim(counts_sequence=seq))
-    monkeypatch.setattr(qiskit_api, 'transpile', lambda qc, backend: qc)
+    sim = MockSim(counts_sequence=seq)
+    monkeypatch.setattr(qiskit_api, 'simulator', sim)
 
     res = client.post('/api/phase3/attack', json={'shots': 100, 'intercept_prob': 1.0})
     assert res.status_code == 200
     data = res.json()
-    assert 's_value' in data
-    assert data['is_secure'] in (True, False)
+    # S = |-1 - (-1) + 0.5 + (-1)| = 0.5
+    assert abs(data['s_value'] - 0.5) < 1e-9
+    assert data['is_secure'] is False
+    assert len(sim.submitted) == 1
+    assert all(qc.num_clbits == 4 for qc in sim.submitted[0])
+
+
+def test_attack_mixes_bell_and_eve_with_mock(monkeypatch):
+    # Half of each pair's shots intercepted: 4 Bell circuits then 4 Eve circuits, weighted 50/50
+    seq = [
+        {'00': 50},                 # Bell E1 -> corr = 1
+        {'01': 50},                 # Bell E2 -> corr = -1
+        {'00': 50},                 # Bell E3 -> corr = 1
+        {'11': 50},                 # Bell E4 -> corr = 1
+        {'0000': 50},               # Eve E1 -> corr = 1
+        {'0001': 25, '0000': 25},   # Eve E2 -> corr = 0
+        {'1001': 50},               # Eve E3 -> corr = -1
+        {'0100': 50},               # Eve E4 -> corr = 1
+    ]
+    sim = MockSim(counts_sequence=seq)
+    monkeypatch.setattr(qiskit_api, 'simulator', sim)
+    monkeypatch.setattr(qiskit_api, 'rng', SimpleNamespace(
+        binomial=lambda n, p, size: np.full(size, n // 2),
+        choice=lambda opts, size: np.zeros(size, dtype=int),
+    ))
+
+    res = client.post('/api/phase3/attack', json={'shots': 100, 'intercept_prob': 0.5})
+    assert res.status_code == 200
+    data = res.json()
+    # Mixed correlations: [1, -0.5, 0, 1] -> S = |1 + 0.5 + 0 + 1| = 2.5
+    assert data['correlations'] == [1.0, -0.5, 0.0, 1.0]
+    assert abs(data['s_value'] - 2.5) < 1e-9
+    assert [len(batch) for batch in sim.submitted] == [4, 4]
 
 
 def test_endpoints_validate_input():
     # Bad payload type should return 422
     res = client.post('/api/phase1/chsh', json={'shots': 'not-a-number'})
     assert res.status_code == 422
+    # Negative round counts are rejected instead of crashing the sampler
+    res = client.post('/api/phase2/keygen', json={'count': -1})
+    assert res.status_code == 422
 
 
 def test_simulator_exception_propagates(monkeypatch):
@@ -82,9 +122,8 @@ def test_simulator_exception_propagates(monkeypatch):
         raise RuntimeError('simulator failed')
 
     monkeypatch.setattr(qiskit_api, 'simulator', SimpleNamespace(run=bad_run, num_qubits=2))
-    monkeypatch.setattr(qiskit_api, 'transpile', lambda qc, backend: qc)
     # Prevent server exceptions from being re-raised by TestClient so we can assert the 500 response
     from fastapi.testclient import TestClient as LocalTestClient
     with LocalTestClient(qiskit_api.app, raise_server_exceptions=False) as c:
-        res = c.post('/api/phase1/chsh', json={'shots': 10})
+        res = c.post('/api/phase1/chsh', json={'shots': 10, 'monte_carlo': True})
     assert res.status_code == 500
\ No newline at end of file